@@ -25,17 +25,27 @@ SOFTWARE.
 """
 import sys
 import os
+import asyncio
 import logging
+import io
 import zipfile
 import gzip
-import datetime
-from tornado import gen
+import functools
+import importlib.util
 from tornado.httpclient import HTTPRequest
 from tornado.httpclient import HTTPError
-from tornado.simple_httpclient import AsyncHTTPClient
+from tornado.httpclient import AsyncHTTPClient
 from tornado.httputil import format_timestamp
 from io import BytesIO
-from .cache import Cache, Response
+from .cache import Cache, Response, get_buffer, GZ_MAGIC, ZIP_MAGIC
+
+# libcurl keeps connections alive between requests; fall back to Tornado's
+# simple client (a fresh connection per fetch) when pycurl isn't installed.
+if importlib.util.find_spec('pycurl'):
+    HTTP_CLIENT = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+    AsyncHTTPClient.configure(HTTP_CLIENT)
+else:
+    HTTP_CLIENT = None
 
 # Logging stuff.
 LOG_DIR = 'log'
@@ -44,7 +54,7 @@ LOG_MSG_FORMAT = '%(asctime)s [{0}] %(levelname)s - %(message)s'
 LOG_DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 DEFAULT_LOG_LEVEL = logging.INFO
 
-MAX_CLIENTS = 10
+MAX_CLIENTS = 100
 CONNECT_TIMEOUT = 5000
 REQUEST_TIMEOUT = 400
 USER_AGENT = 'Mozilla/5.0 (compatible; CacheClient 0.1; [contact]@[site])'
@@ -55,6 +65,8 @@ SOFT_REDIRECT = 302
 FILE_UNCHANGED = 304
 IF_MODIFIED_SINCE = 'If-Modified-Since'
 REFRESH_COOLDOWN = 300  # in Seconds
+FLUSH_RETRY_DELAY = 5  # in Seconds, doubled after each failed retry
+FLUSH_MAX_RETRIES = 5  # before deferred writes are dropped
 
 # Filename stuff
 CSV_EXT = '.csv'
@@ -62,7 +74,12 @@ XLS_EXT = '.xls'
 XLSX_EXT = '.xlsx'
 ZIP_EXT = '.zip'
 GZ_EXT = '.gz'
+READ_BUFFER_SIZE = 64 * 1024
+GZ_MEMORY_LIMIT = 64 * 1024 * 1024  # Larger gzip files are streamed.
+
 
+# The same cached timestamps are sent over and over by polling clients.
+_http_date = functools.lru_cache(maxsize=1024)(format_timestamp)
 
 DEFAULTS = dict(connect_timeout=CONNECT_TIMEOUT, user_agent=USER_AGENT,
                 request_timeout=REQUEST_TIMEOUT)
@@ -97,11 +114,13 @@ def init_logger(name, log_file, additional_logs=None,
     return logging.getLogger(name)
 
 
-def decompress_response(response, target=str()):
+def decompress_response(response, target=''):
     """Decompress file, and return `target` or the only file from it.
 
-    This method now first tests if the file is a ZipFile, and then falls back
-    to gzip.
+    The archive type is sniffed from its leading magic bytes, with a full
+    ZipFile check only when those are inconclusive, and otherwise falls back
+    to gzip. Gzip files under `GZ_MEMORY_LIMIT` are decompressed in one go,
+    larger ones are returned as a buffered stream.
 
     Args:
         response (BytesIO): raw response from CacheClient.
@@ -112,26 +131,29 @@ def decompress_response(response, target=str()):
     Returns:
         target (BytesIO): a file-like object of the target.
     """
-    if not zipfile.is_zipfile(response):
+    head = response.read(len(ZIP_MAGIC))
+    response.seek(0)
+    if head.startswith(GZ_MAGIC) or (
+            head != ZIP_MAGIC and not zipfile.is_zipfile(response)):
+        data = response.getvalue()
+        if len(data) <= GZ_MEMORY_LIMIT:
+            return BytesIO(gzip.decompress(data))
         response.seek(0)
         gzfile = gzip.GzipFile(fileobj=response)
-        return gzfile
+        return io.BufferedReader(gzfile, buffer_size=READ_BUFFER_SIZE)
     zfile = zipfile.ZipFile(response, 'r')
     target = target.lower()
     namelist = zfile.namelist()
-    for name in namelist:
-        lower = name.lower().replace(' ', '_')
-        if not ((target in lower and CSV_EXT in lower) or len(namelist) == 1):
-            continue
-        buf = BytesIO()
-        with zfile.open(name) as zip_file:
-            for line in zip_file:
-                buf.write(line)
-        buf.seek(0)
-        return buf
+    if len(namelist) == 1:
+        chosen = namelist[0]
     else:
+        chosen = next((name for name in namelist
+                       if name.lower().endswith(CSV_EXT) and
+                       target in name.lower().replace(' ', '_')), None)
+    if chosen is None:
         response.seek(0)
         return response
+    return BytesIO(zfile.read(chosen))
 
 
 class CacheClient(object):
@@ -139,14 +161,31 @@ class CacheClient(object):
     def __init__(self, ioloop):
         self._log = init_logger(type(self).__name__, LOG_FILE)
         self.cache = Cache()
-        self._client = AsyncHTTPClient()
-        self._client.initialize(ioloop, defaults=DEFAULTS,
-                                max_clients=MAX_CLIENTS)
+        # Our own instance, so that MAX_CLIENTS and DEFAULTS always apply.
+        self._client = AsyncHTTPClient(force_instance=True,
+                                       max_clients=MAX_CLIENTS,
+                                       defaults=DEFAULTS)
         self.ioloop = ioloop
-
-    @gen.coroutine
-    def fetch(self, target, refresh=False, cache=True, delay=None,
-              follow=True, extract=None, **kwargs):
+        self._pending = []
+        self._batching = 0
+        self._flush_handle = None
+        self._flush_failures = 0
+
+    def close(self):
+        """Write deferred responses, then close the HTTP client and Cache."""
+        self._cancel_flush_retry()
+        if self._pending:
+            try:
+                self.cache.add_many(self._pending)
+            except Exception as excp:
+                self._log.exception(excp)
+                self._drop_pending()
+            self._pending = []
+        self._client.close()
+        self.cache.close()
+
+    async def fetch(self, target, refresh=False, cache=True, delay=None,
+                    follow=True, extract=None, defer=False, **kwargs):
         """Fetch a URL from the wild, but first check the Cache.
 
         Args:
@@ -163,6 +202,9 @@ class CacheClient(object):
             extract (str, optional): if supplied, the Client will try to
                 extract a filename of `extract` from any resulting compressed
                 file. 
+            defer (bool, optional): if True, the result is cached along with
+                other deferred results once the IOLoop is idle (see
+                `cache_response`). Defaults to False.
             **kwargs (misc., optional): any additional keyword arguments that
                 should be passed when a new HTTPRequest is initialized. 
 
@@ -174,27 +216,37 @@ class CacheClient(object):
                     a fresh response from the target server.
                 or None if an error occurred (which is logged).
         """
+        # Responses headed for the cache are streamed straight into our own
+        # buffer, rather than having Tornado collect the body for us to copy.
+        body = None
+        if (cache and not isinstance(target, HTTPRequest) and
+                'streaming_callback' not in kwargs):
+            body = BytesIO()
+            kwargs['streaming_callback'] = body.write
         request = self._cached_http_request(target, follow_redirects=follow,
                                             **kwargs)
         self._log.debug("Fetching file @ {}".format(request.url))
         if not refresh and IF_MODIFIED_SINCE in request.headers:
             self._log.debug("Have cached file, not asking for a refresh.")
-            response = self.cache.load(request.url)
-            raise gen.Return(response)
+            response = self._load_cached(request)
+            if response is not None:
+                return response
         elif IF_MODIFIED_SINCE in request.headers:
             last_mod = request.headers[IF_MODIFIED_SINCE]
-            age = datetime.datetime.now() - last_mod
-            if age.seconds < REFRESH_COOLDOWN:
+            age = self.cache.age(request.url)
+            if age is not None and age < REFRESH_COOLDOWN:
                 self._log.debug("Have recent cached file, not refreshing.")
-                raise gen.Return(self.cache.load(request.url))
+                response = self._load_cached(request)
+                if response is not None:
+                    return response
             else:
-                request.headers[IF_MODIFIED_SINCE] = format_timestamp(last_mod)
+                request.headers[IF_MODIFIED_SINCE] = _http_date(last_mod)
         try:
-            response = yield self._client.fetch(request)
+            response = await self._client.fetch(request)
         except HTTPError as err:
             if err.code == FILE_UNCHANGED:
                 self._log.debug("File unchanged, using cached version.")
-                raise gen.Return(self.cache.load(request.url))
+                return self.cache.load(request.url)
 
             # If we get a 302, and we're expecting it, return the location and
             # fresh to indicate that the destination is a new one (since we
@@ -202,34 +254,145 @@ class CacheClient(object):
             elif err.code == SOFT_REDIRECT and not follow:
                 loc = err.response.headers[LOCATION_HEADER]
                 self._log.debug('Redirected to {}, not following'.format(loc))
-                response = Response(BytesIO(loc), request.url, True)
-                raise gen.Return(response)
+                response = Response(BytesIO(loc.encode()), request.url, True)
+                return response
             else:
                 self._log.error(
                     "{0} ({1}) fetching {2}".format(err, err.code, request.url))
-                raise gen.Return(None)
+                return None
 
         except Exception as excp:
             self._log.exception(excp)
-            raise gen.Return(None)
+            return None
         else:
             self._log.debug("Got fresh file @ {0}".format(request.url))
+            if body is not None:
+                body.seek(0)
+                response.buffer = body
             if extract:
                 response.buffer = decompress_response(response.buffer, extract)
 
             if cache:
                 self._log.debug("Caching {0}".format(request.url))
-                self.cache_response(response, overwrite=True)
+                self.cache_response(response, overwrite=True, defer=defer)
             response = Response(response.buffer, request.url, True)
-            raise gen.Return(response)
+            return response
         finally:
             if delay:
                 self._log.debug("Pausing @ {0} for {1} sec(s)".format(
                     self.ioloop.time(), delay))
-                yield gen.sleep(delay)
+                await asyncio.sleep(delay)
+
+    async def fetch_many(self, targets, **kwargs):
+        """Fetch several URLs concurrently, caching the results together.
+
+        Fresh results are written in a single transaction once every fetch has
+        finished (or, if other `fetch_many` calls overlap, once the last of
+        them has).
+
+        Args:
+            targets (iterable): str or HTTPRequest objects to be fetched.
+            **kwargs (misc., optional): passed along to each `fetch`.
 
-    def cache_response(self, response, overwrite=False):
-        self.cache.add(response.request.url, response.buffer, overwrite, True)
+        Returns:
+            responses (list): the result of `fetch` for each target, in order.
+        """
+        kwargs.setdefault('defer', True)
+        self._batching += 1
+        try:
+            return await asyncio.gather(
+                *(self.fetch(target, **kwargs) for target in targets))
+        finally:
+            self._batching -= 1
+            self.flush_cache()
+
+    def cache_response(self, response, overwrite=False, defer=False):
+        """Save a response to the Cache.
+
+        Args:
+            response (HTTPResponse): the response to be cached.
+            overwrite (bool, optional): should existing entries be replaced?
+            defer (bool, optional): if True, the response is queued and written
+                alongside any other deferred responses in one transaction once
+                the IOLoop is idle. Deferred writes always overwrite.
+        """
+        if not defer:
+            self.cache.add(response.request.url, response.buffer, overwrite,
+                           True)
+            return
+        # While fetch_many is gathering, it does the flush itself at the end.
+        if not self._pending and not self._batching:
+            self.ioloop.add_callback(self.flush_cache)
+        # Read the content now, as the caller may consume the buffer first.
+        self._pending.append((response.request.url,
+                              get_buffer(response.buffer)))
+
+    def flush_cache(self):
+        """Write any deferred responses to the Cache.
+
+        If the write fails, the responses are kept and a single retry is
+        scheduled, backing off from `FLUSH_RETRY_DELAY` seconds. After
+        `FLUSH_MAX_RETRIES` failures the responses are logged and dropped.
+        Nothing is written while a `fetch_many` batch is still gathering.
+        """
+        if self._batching:
+            return
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self.cache.add_many(pending)
+        except Exception as excp:
+            self._log.exception(excp)
+            self._pending = pending + self._pending
+            self._flush_failures += 1
+            if self._flush_failures > FLUSH_MAX_RETRIES:
+                self._drop_pending()
+            elif self._flush_handle is None:
+                delay = FLUSH_RETRY_DELAY * 2 ** (self._flush_failures - 1)
+                self._flush_handle = self.ioloop.call_later(
+                    delay, self._retry_flush)
+        else:
+            self._flush_failures = 0
+            self._cancel_flush_retry()
+
+    def _retry_flush(self):
+        """Run the scheduled retry of `flush_cache`."""
+        self._flush_handle = None
+        self.flush_cache()
+
+    def _cancel_flush_retry(self):
+        """Cancel the scheduled retry of `flush_cache`, if any."""
+        if self._flush_handle is not None:
+            self.ioloop.remove_timeout(self._flush_handle)
+            self._flush_handle = None
+
+    def _drop_pending(self):
+        """Give up on the deferred responses, logging which were lost."""
+        self._log.error("Dropping {0} deferred cache write(s): {1}".format(
+            len(self._pending), ', '.join(url for url, _ in self._pending)))
+        self._pending = []
+        self._flush_failures = 0
+        self._cancel_flush_retry()
+
+    def _load_cached(self, request):
+        """Load a request's url from the Cache.
+
+        If the cached copy has gone (e.g. another Cache cleared it), the
+        request's If-Modified-Since header is dropped so that it can be
+        fetched afresh.
+
+        Args:
+            request (HTTPRequest): carrying an If-Modified-Since header.
+
+        Returns:
+            response (cache.Response or None): the cached copy, if any.
+        """
+        response = self.cache.load(request.url)
+        if response is None:
+            self._log.debug("Cached file is gone, fetching it again.")
+            del request.headers[IF_MODIFIED_SINCE]
+        return response
 
     def _cached_http_request(self, target, **kwargs):
         """Create an HTTPRequest object with a timestamp.
@@ -247,3 +410,4 @@ class CacheClient(object):
         if last_mod:
             target.headers[IF_MODIFIED_SINCE] = last_mod
         return target
+
@@ -27,84 +27,250 @@ SOFTWARE.
 """
 import sqlite3
 import datetime
+import zlib
+import time
 import threading
+import contextlib
 import os
 from io import BytesIO
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 
 # Caching constants
 CACHE_FILE = 'cache.db'
 CACHE_TABLE = 'locations'
+LAST_MOD_CACHE_SIZE = 4096  # urls whose last_modified is kept in memory
+MAX_MEM_BYTES = 128 * 1024 * 1024  # bytes of content kept in memory
+COMPRESS_LEVEL = 3
+
+# Values of the `encoding` column. Rows written before the column was added
+# default to RAW.
+RAW = 0
+COMPRESSED = 1
+
+# Archives are already compressed, so they're stored without another attempt.
+GZ_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+
 FIELDS = ','.join(['url TEXT PRIMARY KEY', 'content BLOB',
-                   "last_modified TIMESTAMP DEFAULT (datetime('now', 'localtime'))"])
+                   "last_modified TIMESTAMP DEFAULT (datetime('now', 'localtime'))",
+                   'encoding INTEGER DEFAULT 0'])
 
 LAST_MOD = "SELECT last_modified FROM {} WHERE url=?".format(CACHE_TABLE)
-INSERT = 'INSERT INTO {} (content, url) VALUES (?, ?)'.format(CACHE_TABLE)
-UPDATE = 'UPDATE {} SET content=?, last_modified=? WHERE url=?'.format(
-    CACHE_TABLE)
-SELECT = 'SELECT content FROM {} WHERE url=?'.format(CACHE_TABLE)
+EXISTS = 'SELECT 1 FROM {} WHERE url=?'.format(CACHE_TABLE)
+UPSERT = ('INSERT INTO {} (url, content, encoding, last_modified) '
+          'VALUES (?, ?, ?, ?) '
+          'ON CONFLICT(url) DO UPDATE SET content=excluded.content, '
+          'encoding=excluded.encoding, '
+          'last_modified=excluded.last_modified'.format(CACHE_TABLE))
+SELECT = 'SELECT content, encoding FROM {} WHERE url=?'.format(CACHE_TABLE)
 CREATE = 'CREATE TABLE IF NOT EXISTS {} ({})'.format(CACHE_TABLE, FIELDS)
+COLUMNS = 'PRAGMA table_info({})'.format(CACHE_TABLE)
+ADD_ENCODING = 'ALTER TABLE {} ADD COLUMN encoding INTEGER DEFAULT 0'.format(
+    CACHE_TABLE)
 CLEAR = 'DELETE FROM LOCATIONS'
+BEGIN = 'BEGIN IMMEDIATE'
+
+# WAL lets readers proceed while a write is in progress, and commits become an
+# append to the log rather than a full fsync of the database file. The busy
+# timeout (in ms) makes a locked database block rather than raise.
+PRAGMAS = ('PRAGMA busy_timeout=5000', 'PRAGMA journal_mode=WAL',
+           'PRAGMA synchronous=NORMAL', 'PRAGMA temp_store=MEMORY',
+           'PRAGMA mmap_size=268435456', 'PRAGMA cache_size=-65536')
 
 
-def _get_buffer(buf):
-    val = buf
-    if not isinstance(buf, (basestring)):
-            line = buf.tell()
-            val = buf.read()
-            buf.seek(line)
+def get_buffer(buf):
+    """Return the content of `buf` as bytes, leaving its position alone."""
+    if isinstance(buf, bytes):
+        return buf
+    elif isinstance(buf, str):
+        return buf.encode('utf-8')
+    elif isinstance(buf, (bytearray, memoryview)):
+        return bytes(buf)
+    elif isinstance(buf, BytesIO) and not buf.tell():
+        # getvalue() hands back BytesIO's own bytes object without copying.
+        return buf.getvalue()
+    line = buf.tell()
+    val = buf.read()
+    buf.seek(line)
     return val
 
 
+def _encode(val):
+    """Compress bytes for storage, returning them with their encoding.
+
+    Archives, and anything else that doesn't shrink, are stored raw.
+    """
+    if val.startswith((GZ_MAGIC, ZIP_MAGIC)):
+        return val, RAW
+    packed = zlib.compress(val, COMPRESS_LEVEL)
+    if len(packed) < len(val):
+        return packed, COMPRESSED
+    return val, RAW
+
+
+def _decode(content, encoding):
+    """Reverse `_encode` on content loaded from the database."""
+    if encoding == COMPRESSED:
+        return zlib.decompress(content)
+    return content
+
+
+def _connect():
+    """Open a tuned, autocommitting connection to the cache database."""
+    conn = sqlite3.connect(CACHE_FILE, detect_types=sqlite3.PARSE_DECLTYPES,
+                           isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
 Response = namedtuple('Response', ('buffer', 'url', 'fresh'))
 
 def block_and_execute(meth):
-    """Wrapper method acquires lock and tries operation until DB is open.
+    """Wrapper method holds the writer lock while operating on the database.
+
+    In WAL mode the lock is a no-op and contention on the database is left to
+    sqlite's busy handler (see `PRAGMA busy_timeout`), which backs off and
+    retries in C.
 
     Args:
         meth (method): to operate on the database.
     """
 
     def _method(self, *args, **kwargs):
-        while True:
-            try:
-                self._lock.acquire()
-                result = meth(self, *args, **kwargs)
-            except sqlite3.OperationalError:
-                pass
-            except Exception:
-                raise
-            else:
-                break
-            finally:
-                self._lock.release()
-        return result
+        with self._lock:
+            return meth(self, *args, **kwargs)
     return _method
 
 
 class Cache(object):
 
-    """Lightweight sqlite3 interface for CRUD transactions into a URL cache."""
+    """Lightweight sqlite3 interface for CRUD transactions into a URL cache.
+
+    Each thread gets its own connection. When the database is in WAL mode
+    readers and writers never block each other in Python; otherwise writes are
+    serialized behind a lock.
+    """
 
     def __init__(self):
-        self.conn = sqlite3.connect(CACHE_FILE,
-                                    detect_types=sqlite3.PARSE_DECLTYPES)
-        self.conn.text_factory = BytesIO
-        self.cursor = self.conn.cursor()
-        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns = []
+        self._lm_cache = OrderedDict()
+        self._lm_lock = threading.Lock()
+        self._mem = OrderedDict()
+        self._mem_bytes = 0
+        self._mem_lock = threading.Lock()
+        mode = self._conn().execute('PRAGMA journal_mode').fetchone()[0]
+        if mode.lower() == 'wal':
+            self._lock = contextlib.nullcontext()
+        else:
+            self._lock = threading.Lock()
         self.create()
 
+    def _conn(self):
+        """Return the calling thread's connection, opening it if needed."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = _connect()
+            self._conns.append(conn)
+        return conn
+
+    def _remember(self, url, last_mod, stamp=None):
+        """Record `last_mod` for `url`, evicting the least recently used.
+
+        Alongside it we keep `stamp`, the same moment on the monotonic clock,
+        so that `age` doesn't need any datetime arithmetic. Returns the
+        (last_mod, stamp) entry.
+        """
+        if stamp is None:
+            age = datetime.datetime.now() - last_mod
+            stamp = time.monotonic() - age.total_seconds()
+        with self._lm_lock:
+            self._lm_cache[url] = (last_mod, stamp)
+            self._lm_cache.move_to_end(url)
+            while len(self._lm_cache) > LAST_MOD_CACHE_SIZE:
+                self._lm_cache.popitem(last=False)
+        return last_mod, stamp
+
+    def _admit(self, url, val):
+        """Keep `val` in memory for `url`, evicting the least recently used."""
+        with self._mem_lock:
+            old = self._mem.pop(url, None)
+            if old is not None:
+                self._mem_bytes -= len(old)
+            if len(val) > MAX_MEM_BYTES:
+                return
+            self._mem[url] = val
+            self._mem_bytes += len(val)
+            while self._mem_bytes > MAX_MEM_BYTES:
+                _, old = self._mem.popitem(last=False)
+                self._mem_bytes -= len(old)
+
+    def _uncommitted(self):
+        """Return the calling thread's writes that are awaiting a commit."""
+        writes = getattr(self._local, 'writes', None)
+        if writes is None:
+            writes = self._local.writes = []
+        return writes
+
+    def _begin(self):
+        """Open a write transaction on the calling thread's connection."""
+        conn = self._conn()
+        if not conn.in_transaction:
+            conn.execute(BEGIN)
+        return conn
+
+    def _commit(self, conn):
+        """Commit, then let the in-memory caches see the committed writes."""
+        conn.commit()
+        writes = self._uncommitted()
+        for url, val, now, stamp in writes:
+            self._remember(url, now, stamp)
+            self._admit(url, val)
+        del writes[:]
+
+    def _rollback(self, conn):
+        """Roll back, so a failed write can't hold the database locked."""
+        conn.rollback()
+        del self._uncommitted()[:]
+
     @block_and_execute
     def create(self):
-        """Create a cache table."""
-        self.conn.execute(CREATE, ())
+        """Create a cache table, adding any columns missing from an old one."""
+        conn = self._begin()
+        try:
+            conn.execute(CREATE, ())
+            columns = [row[1] for row in conn.execute(COLUMNS)]
+            if 'encoding' not in columns:
+                conn.execute(ADD_ENCODING)
+            conn.commit()
+        except Exception:
+            self._rollback(conn)
+            raise
+
+    def commit(self):
+        """Commit writes made from the calling thread with `commit=False`."""
+        self._commit(self._conn())
 
     def close(self):
-        """Close the database connection and release the cursor."""
-        self.conn.close()
+        """Close the database connections of every thread."""
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        self._local = threading.local()
+
+    def _last_modified(self, url):
+        """Return the (datetime, monotonic stamp) pair for `url`, if cached."""
+        with self._lm_lock:
+            entry = self._lm_cache.get(url)
+            if entry:
+                self._lm_cache.move_to_end(url)
+                return entry
+        last_mod = self._conn().execute(LAST_MOD, (url,)).fetchone()
+        if last_mod and last_mod[0]:
+            return self._remember(url, last_mod[0])
 
-    @block_and_execute
     def last_modified(self, url):
         """Retrive the last modification datetime for a given url.
 
@@ -115,10 +281,23 @@ class Cache(object):
             last_mod (datetime.datetime): last updated. Sqlite3 automatically
                 converts to datetime.datetime because detect_types is set.
         """
-        self.cursor.execute(LAST_MOD, (url,))
-        last_mod = self.cursor.fetchone()
-        if last_mod and last_mod[0]:
-            return last_mod[0]
+        entry = self._last_modified(url)
+        if entry:
+            return entry[0]
+
+    def age(self, url):
+        """Retrieve the number of seconds since a given url was last modified.
+
+        Args:
+            url (string): the url to retrieve.
+
+        Returns:
+            age (float): seconds since the last update, or None if the url
+                isn't cached.
+        """
+        entry = self._last_modified(url)
+        if entry:
+            return time.monotonic() - entry[1]
 
     @block_and_execute
     def add(self, url, buf, overwrite=False, commit=True):
@@ -126,10 +305,9 @@ class Cache(object):
 
         Args:
             url (string): the url to save the object to.
-            buf (misc., sqlite3-adapted): the buffer to be saved to the cache.
-                Note that this argument must have been adapted for sqlite3
-                insertion. BytesIO, strings, unicode and core Python types are
-                all acceptable.
+            buf (file-like, bytes or str): the buffer to be saved to the cache.
+                File-like objects are read from their current position, and
+                strings are saved UTF-8 encoded.
             overwrite (bool): if True, the cache will overwrite pre-existing
                 entries for the same url.
             commit (bool): if True, the Cache will commit the insert after.
@@ -137,20 +315,43 @@ class Cache(object):
                 anticipated, to improve performance. In that case, a manual
                 commit should be issued after.
         """
-        val = _get_buffer(buf)
+        now, stamp = datetime.datetime.now(), time.monotonic()
+        conn = self._begin()
         try:
-            self.cursor.execute(INSERT, (val, url))
+            # The write lock is held from BEGIN IMMEDIATE, so the row can't
+            # appear between this check and the write. Checking first avoids
+            # reading and compressing content that would only be discarded.
+            if overwrite or not conn.execute(EXISTS, (url,)).fetchone():
+                val = get_buffer(buf)
+                conn.execute(UPSERT, (url,) + _encode(val) + (now,))
+                self._uncommitted().append((url, val, now, stamp))
             if commit:
-                self.conn.commit()
-        except sqlite3.IntegrityError:
-            if overwrite:
-                val = _get_buffer(buf)
-                now = datetime.datetime.now()
-                self.cursor.execute(UPDATE, (val, now, url))
-                if commit:
-                    self.conn.commit()
+                self._commit(conn)
+        except Exception:
+            self._rollback(conn)
+            raise
 
     @block_and_execute
+    def add_many(self, rows):
+        """Add (and overwrite) a group of locations in a single transaction.
+
+        Args:
+            rows (iterable): of (url, buf) pairs, where `buf` follows the same
+                rules as in `add`.
+        """
+        now, stamp = datetime.datetime.now(), time.monotonic()
+        rows = [(url, get_buffer(buf)) for url, buf in rows]
+        conn = self._begin()
+        try:
+            conn.executemany(
+                UPSERT, ((url,) + _encode(val) + (now,) for url, val in rows))
+            self._uncommitted().extend(
+                (url, val, now, stamp) for url, val in rows)
+            self._commit(conn)
+        except Exception:
+            self._rollback(conn)
+            raise
+
     def load(self, url):
         """Load a cached location from the cache.
 
@@ -161,16 +362,32 @@ class Cache(object):
             response (Response): a Response object containing the url (string)
                 and buffer (BytesIO).
         """
-        self.cursor.execute(SELECT, (url,))
-        content = self.cursor.fetchone()
+        with self._mem_lock:
+            val = self._mem.get(url)
+            if val is not None:
+                self._mem.move_to_end(url)
+        if val is not None:
+            return Response(BytesIO(val), url, False)
+        content = self._conn().execute(SELECT, (url,)).fetchone()
         if content:
-            content = content[0]
-            if isinstance(content, buffer):
-                content = BytesIO(content)
-            return Response(content, url, False)
+            return Response(BytesIO(_decode(*content)), url, False)
+        # The row may have been removed through another Cache.
+        with self._lm_lock:
+            self._lm_cache.pop(url, None)
 
     @block_and_execute
     def clear(self):
         """Empty the cache."""
-        self.cursor.execute(CLEAR)
-        self.conn.commit()
+        conn = self._begin()
+        try:
+            conn.execute(CLEAR)
+            del self._uncommitted()[:]
+            conn.commit()
+        except Exception:
+            self._rollback(conn)
+            raise
+        with self._lm_lock:
+            self._lm_cache.clear()
+        with self._mem_lock:
+            self._mem.clear()
+            self._mem_bytes = 0
@@ -2,10 +2,19 @@
 
 from __future__ import absolute_import, division, print_function, with_statement
 
+import asyncio
+import gzip
+import os
+import sqlite3
+import zipfile
+import threading
+import unittest
 from io import BytesIO
+from unittest import mock
 from tornado.testing import AsyncHTTPTestCase, gen_test
 from tornado.web import Application, RequestHandler, url
-from client import CacheClient
+from client import CacheClient, HTTP_CLIENT, FLUSH_MAX_RETRIES
+from client.cache import Cache, CACHE_FILE
 
 
 class HelloWorldHandler(RequestHandler):
@@ -36,12 +45,37 @@ class CountdownHandler(RequestHandler):
             self.write("Zero")
 
 
+class ArchiveHandler(RequestHandler):
+    MEMBERS = {
+        "zip": {"readme.txt": b"Read me", "My Data.csv": b"a,b\n1,2\n",
+                "other.csv": b"c,d\n"},
+        "single": {"only.txt": b"Only me"},
+    }
+
+    def get(self, kind):
+        self.set_header("Content-Type", "application/octet-stream")
+        if kind == "gz":
+            self.finish(gzip.compress(b"a,b\n1,2\n"))
+            return
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, "w") as zfile:
+            for name, content in self.MEMBERS[kind].items():
+                zfile.writestr(name, content)
+        self.finish(buf.getvalue())
+
+
+class SlowHandler(RequestHandler):
+    async def get(self, millis):
+        await asyncio.sleep(int(millis) / 1000)
+        self.finish("Slept %s" % millis)
+
+
 class CacheClientCommonTestCase(AsyncHTTPTestCase):
 
     def tearDown(self):
         self.http_server.stop()
         self.http_client.cache.clear()
-        self.http_client.cache.close()
+        self.http_client.close()
         super(AsyncHTTPTestCase, self).tearDown()
 
     def get_http_client(self):
@@ -53,6 +87,8 @@ class CacheClientCommonTestCase(AsyncHTTPTestCase):
             url("/post", PostHandler),
             url("/redirect", RedirectHandler),
             url("/countdown/([0-9]+)", CountdownHandler, name="countdown"),
+            url("/archive/(gz|zip|single)", ArchiveHandler),
+            url("/slow/([0-9]+)", SlowHandler),
         ], gzip=True)
 
     def fetch(self, path, **kwargs):
@@ -87,6 +123,124 @@ class CacheClientCommonTestCase(AsyncHTTPTestCase):
         self.assertEqual(response.buffer.read(), b"Hello Drew!")
         self.assertEqual(response.fresh, False)
 
+    @gen_test
+    def test_hello_world_refresh_recent(self):
+        response = yield self.fetch("/hello", refresh=True)
+        self.assertEqual(response.fresh, True)
+
+        # Still within the refresh cooldown, so the server isn't asked again.
+        response = yield self.fetch("/hello", refresh=True)
+        self.assertEqual(response.buffer.read(), b"Hello world!")
+        self.assertEqual(response.fresh, False)
+
+    @gen_test
+    def test_fetch_many(self):
+        paths = ["/hello", "/hello?name=Drew"]
+        responses = yield self.http_client.fetch_many(
+            [self.get_url(path) for path in paths])
+        self.assertEqual([r.buffer.read() for r in responses],
+                         [b"Hello world!", b"Hello Drew!"])
+        self.assertEqual([r.fresh for r in responses], [True, True])
+
+        response = yield self.fetch("/hello?name=Drew")
+        self.assertEqual(response.buffer.read(), b"Hello Drew!")
+        self.assertEqual(response.fresh, False)
+
+    @gen_test
+    def test_extract_gzip(self):
+        response = yield self.fetch("/archive/gz", extract="data")
+        self.assertEqual(response.buffer.read(), b"a,b\n1,2\n")
+
+    @gen_test
+    def test_extract_gzip_streamed(self):
+        with mock.patch("client.GZ_MEMORY_LIMIT", 0):
+            response = yield self.fetch("/archive/gz", extract="data")
+        self.assertEqual(response.buffer.read(), b"a,b\n1,2\n")
+
+    @gen_test
+    def test_extract_zip_by_name(self):
+        response = yield self.fetch("/archive/zip", extract="My_Data")
+        self.assertEqual(response.buffer.read(), b"a,b\n1,2\n")
+
+    @gen_test
+    def test_extract_zip_single_member(self):
+        response = yield self.fetch("/archive/single", extract="data")
+        self.assertEqual(response.buffer.read(), b"Only me")
+
+    @gen_test
+    def test_extract_zip_no_match(self):
+        response = yield self.fetch("/archive/zip", extract="missing")
+        self.assertTrue(zipfile.is_zipfile(response.buffer))
+
+    @gen_test
+    def test_refetch_when_cached_row_is_gone(self):
+        response = yield self.fetch("/hello")
+        self.assertEqual(response.fresh, True)
+
+        # Clear the row through another Cache, and drop our in-memory copy.
+        other = Cache()
+        other.clear()
+        other.close()
+        self.http_client.cache._mem.clear()
+
+        response = yield self.fetch("/hello")
+        self.assertEqual(response.buffer.read(), b"Hello world!")
+        self.assertEqual(response.fresh, True)
+
+    def test_failed_flush_keeps_pending(self):
+        self.http_client._pending = [("http://example.com/", b"x")]
+        with mock.patch.object(self.http_client.cache, "add_many",
+                               side_effect=sqlite3.OperationalError):
+            self.http_client.flush_cache()
+        self.assertEqual(self.http_client._pending,
+                         [("http://example.com/", b"x")])
+
+        self.http_client.flush_cache()
+        self.assertEqual(self.http_client._pending, [])
+        self.assertEqual(
+            self.http_client.cache.load("http://example.com/").buffer.read(),
+            b"x")
+
+    def test_failed_flushes_share_one_retry(self):
+        client = self.http_client
+        client._pending = [("http://example.com/", b"x")]
+        with mock.patch.object(client.cache, "add_many",
+                               side_effect=sqlite3.OperationalError):
+            client.flush_cache()
+            handle = client._flush_handle
+            client.flush_cache()
+            self.assertIs(client._flush_handle, handle)
+
+            for _ in range(FLUSH_MAX_RETRIES):
+                client.flush_cache()
+        self.assertEqual(client._pending, [])
+        self.assertIsNone(client._flush_handle)
+
+    def test_close_writes_pending(self):
+        self.http_client._pending = [("http://example.com/", b"x")]
+        self.http_client.close()
+        self.http_client = CacheClient(ioloop=self.io_loop)
+        self.assertEqual(
+            self.http_client.cache.load("http://example.com/").buffer.read(),
+            b"x")
+
+    @unittest.skipUnless(HTTP_CLIENT, "pycurl is not installed")
+    def test_uses_curl_client(self):
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        self.assertIsInstance(self.http_client._client, CurlAsyncHTTPClient)
+
+    @gen_test
+    def test_fetch_many_writes_one_batch(self):
+        cache = self.http_client.cache
+        paths = ["/slow/{}".format(millis) for millis in (0, 20, 40, 60)]
+        with mock.patch.object(cache, "add_many",
+                               wraps=cache.add_many) as add_many:
+            responses = yield self.http_client.fetch_many(
+                [self.get_url(path) for path in paths])
+        self.assertEqual([r.fresh for r in responses], [True] * 4)
+        add_many.assert_called_once()
+        self.assertEqual(len(add_many.call_args[0][0]), 4)
+
     @gen_test
     def test_post(self):
         response = yield self.fetch("/post", method="POST",
@@ -96,7 +250,7 @@ class CacheClientCommonTestCase(AsyncHTTPTestCase):
     @gen_test
     def test_follow_redirect(self):
         response = yield self.fetch("/countdown/2", follow=False)
-        self.assertTrue(response.buffer.read().endswith("/countdown/1"))
+        self.assertTrue(response.buffer.read().endswith(b"/countdown/1"))
 
         response = yield self.fetch("/countdown/2")
 
@@ -104,3 +258,83 @@ class CacheClientCommonTestCase(AsyncHTTPTestCase):
         # here because it return the ~requested~ url.
         self.assertTrue(response.url.endswith("/countdown/2"))
         self.assertEqual(response.buffer.read(), b"Zero")
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+
+    def tearDown(self):
+        self.cache.clear()
+        self.cache.close()
+
+    def assertRoundTrip(self, content):
+        self.cache.add("http://example.com/", content)
+        self.cache._mem.clear()  # Make load decode the stored row.
+        response = self.cache.load("http://example.com/")
+        self.assertEqual(response.buffer.read(), content)
+
+    def test_compressible_round_trip(self):
+        self.assertRoundTrip(b"a,b,c\n" * 1000)
+
+    def test_incompressible_round_trip(self):
+        self.assertRoundTrip(os.urandom(1000))
+
+    def test_leading_control_bytes_round_trip(self):
+        self.assertRoundTrip(b"\x00\x00\x00\x18ftypmp42")
+        self.cache.clear()
+        self.assertRoundTrip(b"\x01abc")
+
+    def test_add_without_overwrite_keeps_existing_row(self):
+        self.cache.add("http://example.com/", b"a,b,c\n" * 1000)
+        with mock.patch("client.cache._encode") as encode:
+            self.cache.add("http://example.com/", b"x")
+        encode.assert_not_called()
+        self.cache._mem.clear()
+        self.assertEqual(
+            self.cache.load("http://example.com/").buffer.read(),
+            b"a,b,c\n" * 1000)
+
+    def test_row_from_before_encoding_column(self):
+        self.cache.clear()
+        self.cache.close()
+        conn = sqlite3.connect(CACHE_FILE)
+        conn.execute("DROP TABLE locations")
+        conn.execute("CREATE TABLE locations (url TEXT PRIMARY KEY, "
+                     "content BLOB, last_modified TIMESTAMP DEFAULT "
+                     "(datetime('now', 'localtime')))")
+        conn.execute("INSERT INTO locations (url, content) VALUES (?, ?)",
+                     ("http://example.com/", b"\x01abc"))
+        conn.commit()
+        conn.close()
+
+        self.cache = Cache()
+        response = self.cache.load("http://example.com/")
+        self.assertEqual(response.buffer.read(), b"\x01abc")
+
+    def test_failed_add_rolls_back(self):
+        with self.assertRaises(Exception):
+            self.cache.add(['bad'], b"x")
+        self.assertFalse(self.cache._conn().in_transaction)
+
+        # Another thread's connection must still be able to write.
+        errors = []
+
+        def add():
+            try:
+                self.cache.add("http://example.com/", b"x")
+            except Exception as excp:
+                errors.append(excp)
+        thread = threading.Thread(target=add)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.cache.load("http://example.com/").buffer.read(),
+                         b"x")
+
+    def test_uncommitted_add_is_not_cached_in_memory(self):
+        self.cache.add("http://example.com/", b"x", commit=False)
+        self.assertNotIn("http://example.com/", self.cache._mem)
+        self.cache.commit()
+        self.assertIn("http://example.com/", self.cache._mem)